@@ -2,11 +2,28 @@
 Algorithm for k-Means clustering
 """
 import math
-import random
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy
 import dataset
 import cluster
 
+# The compiled kernels are optional, as they need numba
+try:
+    import kernels
+except ImportError:
+    kernels = None
+
+# Number of points processed at a time when computing all distances
+CHUNK = 256
+
+# The compiled kernel is only used for at least KERNEL_MIN_POINTS points, as smaller
+# data sets do not make up for starting its threads.  It is not used for
+# KERNEL_MAX_CLUSTERS clusters or more, as Elkan's bounds then skip more distances
+# than the kernel saves by reading the points once.
+KERNEL_MIN_POINTS = 10000
+KERNEL_MAX_CLUSTERS = 16
+
 def valid_seeds(value, size):
     """
     Returns True if value is a valid list of seeds for clustering.
@@ -34,6 +51,92 @@ def valid_seeds(value, size):
 
     return True
 
+def _kmeanspp(dset, k, rng):
+    """
+    Returns a list of k seeds for the dataset chosen by k-means++.
+
+    The first seed is chosen uniformly at random. Each following seed is chosen with
+    probability proportional to the squared distance from the point to the nearest
+    seed chosen so far.
+
+    Parameter dset: the dataset
+    Precondition: dset is an instance of Dataset
+
+    Parameter k: the number of seeds
+    Precondition: k is an int, 0 < k <= dset.getSize()
+
+    Parameter rng: the source of randomness
+    Precondition: rng is numpy.random or a numpy.random.Generator
+    """
+    points = dset.getArray32()
+    n = len(points)
+
+    seeds = [int(rng.choice(n))]
+    diff = points - points[seeds[0]]
+    r = numpy.einsum('nd,nd->n', diff, diff, dtype=numpy.float64)
+    for i in range(1, k):
+        total = r.sum()
+        if total > 0:
+            seed = int(rng.choice(n, p=r/total))
+        else:
+            # Every point sits on a seed already; pick any unused one
+            seed = int(rng.choice(numpy.setdiff1d(numpy.arange(n), seeds)))
+        seeds.append(seed)
+        diff = points - points[seed]
+        r = numpy.minimum(r, numpy.einsum('nd,nd->n', diff, diff, dtype=numpy.float64))
+
+    return seeds
+
+
+# The points of the dataset in a worker process of Algorithm.run
+_worker_shm = None
+_worker_points = None
+
+
+def _init_worker(name, shape, dtype):
+    """
+    Attaches a worker process to the shared memory block holding the points.
+
+    Parameter name: the name of the shared memory block
+    Precondition: name is a string naming an existing SharedMemory block
+
+    Parameter shape: the shape of the points array
+    Precondition: shape is an (n,d) tuple of ints
+
+    Parameter dtype: the type of the points array
+    Precondition: dtype is a numpy dtype string
+    """
+    global _worker_shm, _worker_points
+    _worker_shm = shared_memory.SharedMemory(name=name)
+    _worker_points = numpy.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf)
+
+
+def _lloyd_chunk(task):
+    """
+    Returns the labels and cluster sums for a slice of the points.
+
+    This is the work done by one worker process during a step. Ties are broken in
+    favor of earlier clusters.
+
+    Parameter task: the slice of points, the centroids and the center
+    Precondition: task is a tuple (start, end, centroids, center) where start and end
+    are ints with 0 <= start < end <= n, centroids is a (k,d) numpy array of floats
+    shifted by center, and center is a (d,) numpy array of floats
+    """
+    start, end, centroids, center = task
+    points = _worker_points[start:end]
+
+    # Shift the points too, so that the norms stay small for data far from the origin
+    shifted = points - center
+    dists = -2 * (shifted @ centroids.T)
+    dists += numpy.einsum('kd,kd->k', centroids, centroids)[None, :]
+    labels = dists.argmin(axis=1)
+
+    sums = numpy.zeros(centroids.shape, dtype=numpy.float64)
+    numpy.add.at(sums, labels, points)
+    return labels, sums
+
+
 class Algorithm(object):
     """
     A class to manage and run the k-means algorithm.
@@ -51,14 +154,15 @@ class Algorithm(object):
         """
         return self._cluster
 
-    def __init__(self, dset, k, seeds=None):
+    def __init__(self, dset, k, seeds=None, processes=None, quantize=False):
         """
         Initializes the algorithm for the dataset ds, using k clusters.
 
         If the optional argument seeds is supplied, those seeds will be a list OR
         tuple of indices into the dataset. They specify which points should be the
-        initial cluster centroids. Otherwise, the clusters are initialized by randomly
-        selecting k different points from the database to be the cluster centroids.
+        initial cluster centroids. Otherwise, the clusters are initialized by choosing
+        k different points from the database with k-means++ seeding. This seeding uses
+        numpy.random, so it is reproduced with numpy.random.seed (not random.seed).
 
         Parameter dset: the dataset
         Precondition: dset is an instance of Dataset
@@ -68,25 +172,89 @@ class Algorithm(object):
 
         Paramter seeds: the initial cluster indices (OPTIONAL)
         Precondition: seeds is None, or a list/tuple of valid seeds.
+
+        Parameter processes: the number of worker processes used by run() when numba is
+        not installed (OPTIONAL)
+        Precondition: processes is None, or an int > 0.
+
+        Parameter quantize: whether to assign points using 8-bit coordinates (OPTIONAL)
+        Precondition: quantize is a bool. If it is True, the nearest cluster of a point
+        is only approximate, but the centroids are still computed from the full points.
         """
         assert isinstance(dset,dataset.Dataset)
         assert isinstance(k,int) and k > 0 and k <= dset.getSize()
         assert seeds == None or valid_seeds(seeds,dset.getSize())
+        assert processes == None or (isinstance(processes,int) and processes > 0)
+        assert type(quantize) == bool
 
         self._dataset = dset
+        self._processes = processes
+        self._quantize = quantize
+        self._pool = None
         if seeds != None:
             #assert len(seeds) == k
             self._cluster = [cluster.Cluster(dset,dset.getPoint(seed)) for seed in seeds]
         else:
-            random_seeds = [random.sample(range(dset.getSize()),k)][0]
+            random_seeds = _kmeanspp(dset,k,numpy.random)
             self._cluster = [cluster.Cluster(dset,dset.getPoint(seed)) for seed in random_seeds]
 
+        self._load_points()
+        self._sync_centroids()
+
+
+    def _load_points(self):
+        """
+        Fetches the arrays of points used by the k-means computations from the dataset.
+
+        The arrays are views of the dataset buffers, so this must be called again when
+        points are added to the dataset.  It also resets the Elkan bounds and the sums
+        of the clusters, which depend on the points.
+        """
+        # The distances are computed from float32 points shifted by _center, but the
+        # sums use the exact values
+        dset = self._dataset
+        self._center = dset.getCenter()
+        self._points = dset.getArray32()
+        self._data = dset.getArray()
+        self._xx = dset.getSquaredNorms()
+        if self._quantize:
+            self._quantized, self._scale, self._offset = dset.getQuantized()
+            self._qq = numpy.einsum('nd,nd->n', self._quantized, self._quantized,
+                dtype=numpy.float64)
+
+        # Elkan bounds: _u[i] is an upper bound on the distance from point i to its
+        # assigned centroid, _l[i,c] is a lower bound on its distance to centroid c.
+        # They are set on the first call to _partition.
+        self._assignments = None
+        self._u = None
+        self._l = None
+
+        # The cluster of each point and the sum and size of each cluster, as of the last
+        # call to _set_labels.  Only the points that change cluster update the sums.
+        self._labels = None
+        self._sums = None
+        self._counts = None
+
+
+    def _sync_centroids(self):
+        """
+        Copies the centroids of all clusters into the (k,d) array self._centroids.
+
+        It also stores them shifted by the center of the dataset in self._shifted, to
+        compare them with the float32 points, and the squared norms of the shifted
+        centroids in self._cc, for use with the squared norms of the points.
+        """
+        self._centroids = numpy.array([cluster.getCentroid() for cluster in self._cluster],
+            dtype=numpy.float64)
+        self._shifted = self._centroids - self._center
+        self._cc = numpy.einsum('kd,kd->k', self._shifted, self._shifted)
+
 
     def _nearest(self, point):
         """
         Returns the cluster nearest to point
 
-        This method uses the distance method of each Cluster to compute the distance
+        This method uses the squared distance of each Cluster to compare the distance
         between point and the cluster centroid. It returns the Cluster that is closest.
 
         Ties are broken in favor of clusters occurring earlier in the list returned
@@ -99,24 +267,175 @@ class Algorithm(object):
         assert dataset.is_point(point) and len(point) == \
         self._dataset.getDimension()
 
-        distances = {}
-        for cluster in self._cluster:
-            distances[cluster] = cluster.distance(point)
-
-        minimum = min(distances.values())
-        return [key for key in distances if distances[key]==minimum][0]
+        # min returns the first minimal cluster, so ties go to earlier clusters
+        return min(self._cluster, key=lambda c: c._distance_sq(point))
 
 
     def _partition(self):
         """
         Repartitions the dataset so each point is in exactly one Cluster.
+
+        The first call computes every point-to-centroid distance.  Later calls use
+        Elkan's triangle inequality bounds to skip the distances that cannot change
+        the nearest cluster of a point.
+
+        If this object was created with quantize=True, every call compares the 8-bit
+        points against all centroids instead.
+        """
+        if self._quantize:
+            self._set_labels(self._partition_quantized())
+            return
+
+        if self._assignments is None:
+            self._partition_full()
+        else:
+            self._partition_pruned()
+
+        self._set_labels(self._assignments)
+
+
+    def _set_labels(self, labels, sums=None, counts=None):
         """
-        # First, clear each cluster of its points.  Then, for each point in the
-        # dataset, find the nearest cluster and add the point to that cluster.
-        for cluster in self._cluster:
-            cluster.clear()
-        for index in range(len(self._dataset.getContents())):
-            self._nearest(self._dataset.getPoint(index)).addIndex(index)
+        Puts every point in the cluster given by labels.
+
+        If sums and counts are None, the sum and size of each cluster are updated from
+        the previous labels by moving only the points that changed cluster.
+
+        Parameter labels: the cluster position of each point
+        Precondition: labels is an (n,) numpy array of ints in 0..k-1
+
+        Parameter sums: the sum of the points in each cluster (OPTIONAL)
+        Precondition: sums is None or a (k,d) numpy array of float64
+
+        Parameter counts: the number of points in each cluster (OPTIONAL)
+        Precondition: counts is None if sums is None, or a (k,) numpy array of ints
+        """
+        k = len(self._cluster)
+        if sums is None:
+            if self._labels is None:
+                sums = numpy.zeros(self._centroids.shape, dtype=numpy.float64)
+                numpy.add.at(sums, labels, self._data)
+                counts = numpy.bincount(labels, minlength=k)
+            else:
+                sums, counts = self._sums, self._counts
+                moved = numpy.nonzero(labels != self._labels)[0]
+                points = self._data[moved]
+                numpy.subtract.at(sums, self._labels[moved], points)
+                numpy.add.at(sums, labels[moved], points)
+                numpy.subtract.at(counts, self._labels[moved], 1)
+                numpy.add.at(counts, labels[moved], 1)
+
+        self._labels = labels.copy()
+        self._sums = sums
+        self._counts = counts
+
+        # Sort the points by cluster once, instead of searching the labels once for
+        # each cluster.  The stable sort keeps the indices of each cluster in order.
+        order = numpy.argsort(labels, kind='stable')
+        ends = numpy.cumsum(counts)
+        for c in range(k):
+            start = ends[c] - counts[c]
+            self._cluster[c]._set_indices(order[start:ends[c]].tolist())
+
+
+    def _partition_full(self):
+        """
+        Assigns every point to its nearest centroid and initializes the Elkan bounds.
+        """
+        # Compute the (n,k) matrix of distances from every point to every centroid,
+        # using ||x-c||^2 = ||x||^2 + ||c||^2 - 2x.c so that the work is a matrix
+        # product.  The points are processed CHUNK at a time so the temporaries stay in
+        # cache.  The bounds need true distances, so the square root is kept here.
+        n, k = len(self._points), len(self._cluster)
+        dists = numpy.empty((n, k), dtype=numpy.float64)
+        for start in range(0, n, CHUNK):
+            end = min(start + CHUNK, n)
+            block = dists[start:end]
+            numpy.matmul(self._points[start:end], self._shifted.T, out=block)
+            block *= -2
+            block += self._xx[start:end, None]
+            block += self._cc[None, :]
+            numpy.maximum(block, 0, out=block)
+            numpy.sqrt(block, out=block)
+
+        # Ties are broken in favor of earlier clusters, just like _nearest
+        labels = dists.argmin(axis=1)
+
+        self._assignments = labels
+        self._u = dists[numpy.arange(len(labels)), labels]
+        self._l = dists
+
+
+    def _partition_quantized(self):
+        """
+        Returns the position of the nearest cluster of each point, using 8-bit points.
+
+        The centroids are scaled the same way as the points, but are not rounded.
+        The points are processed CHUNK at a time, so only one chunk at a time is
+        converted out of 8 bits.
+        """
+        n, k = len(self._quantized), len(self._cluster)
+        centroids = (self._shifted - self._offset)*self._scale
+        cc = numpy.einsum('kd,kd->k', centroids, centroids)
+        labels = numpy.empty(n, dtype=numpy.int64)
+        for start in range(0, n, CHUNK):
+            end = min(start + CHUNK, n)
+            block = -2 * (self._quantized[start:end] @ centroids.T)
+            block += self._qq[start:end, None]
+            block += cc[None, :]
+            labels[start:end] = block.argmin(axis=1)
+
+        return labels
+
+
+    def _partition_pruned(self):
+        """
+        Reassigns points using the Elkan bounds, computing as few distances as possible.
+        """
+        k = len(self._cluster)
+        between = self._centroids[:, None, :] - self._centroids[None, :, :]
+        between = numpy.sqrt(numpy.einsum('ijd,ijd->ij', between, between))
+        others = between + numpy.diag(numpy.full(k, numpy.inf))
+        s = 0.5 * others.min(axis=1)
+
+        # A point is settled if its upper bound is less than half the distance from its
+        # centroid to the nearest other centroid.  The tests below do not rule out ties,
+        # since a tied centroid that comes earlier in the list must win.
+        active = numpy.nonzero(self._u >= s[self._assignments])[0]
+        if len(active) == 0:
+            return
+
+        # A centroid c is a candidate if neither bound rules it out
+        assigned = self._assignments[active]
+        half = 0.5 * between[assigned]
+        rows = numpy.arange(len(active))
+        cand = (self._u[active, None] >= self._l[active]) & (self._u[active, None] >= half)
+        cand[rows, assigned] = False
+        keep = cand.any(axis=1)
+        active, assigned, half, cand = active[keep], assigned[keep], half[keep], cand[keep]
+        if len(active) == 0:
+            return
+
+        # Tighten the upper bound to the exact distance and filter the candidates again
+        rows = numpy.arange(len(active))
+        diff = self._points[active] - self._shifted[assigned]
+        u = numpy.sqrt(numpy.einsum('nd,nd->n', diff, diff))
+        self._l[active, assigned] = u
+        cand &= (u[:, None] >= self._l[active]) & (u[:, None] >= half)
+
+        # Compute the remaining candidate distances only
+        r, c = numpy.nonzero(cand)
+        diff = self._points[active[r]] - self._shifted[c]
+        d = numpy.sqrt(numpy.einsum('nd,nd->n', diff, diff))
+        self._l[active[r], c] = d
+
+        dists = numpy.full((len(active), k), numpy.inf)
+        dists[rows, assigned] = u
+        dists[r, c] = d
+        # argmin returns the first minimum, so ties go to earlier clusters
+        labels = dists.argmin(axis=1)
+        self._assignments[active] = labels
+        self._u[active] = dists[rows, labels]
 
 
     def _update(self):
@@ -126,12 +445,35 @@ class Algorithm(object):
         This method first updates the centroids of all clusters'.  When it is done, it
         checks whether any of them have changed. It returns False if just one has
         changed. Otherwise, it returns True.
+
+        The centroids are computed from the cluster sums kept by _set_labels, instead
+        of calling update() on each cluster.  If there are no sums yet, or the points
+        of a cluster were changed outside of _set_labels, it calls update() instead.
         """
         temp = True
-        for cluster in self._cluster:
-            update = cluster.update()
-            if update == False:
-                temp = False
+        if self._counts is None or any(cluster._modified for cluster in self._cluster):
+            # The sums no longer match the clusters, so _set_labels must start over
+            self._labels = None
+            self._sums = None
+            self._counts = None
+            for cluster in self._cluster:
+                if not cluster.update():
+                    temp = False
+        else:
+            for c in range(len(self._cluster)):
+                # Empty clusters keep their centroid, as in Cluster.update
+                count = self._counts[c]
+                if count > 0 and not self._cluster[c]._set_centroid(self._sums[c]/count):
+                    temp = False
+
+        old = self._centroids
+        self._sync_centroids()
+
+        # Shift the Elkan bounds by how far each centroid moved
+        if self._assignments is not None:
+            moved = numpy.sqrt(((self._centroids - old)**2).sum(axis=1))
+            self._u += moved[self._assignments]
+            self._l = numpy.maximum(self._l - moved, 0)
 
         return temp
 
@@ -144,12 +486,75 @@ class Algorithm(object):
         the algorithm has converged and returns the appropriate result (True if
         converged, false otherwise).
         """
+        if len(self._data) != self._dataset.getSize():
+            self._load_points()
+
+        if self._pool is not None:
+            return self._step_parallel()
+        if self._use_kernel():
+            return self._step_fused()
+
         self._partition()
         no_update = self._update()
 
         return no_update
 
 
+    def _use_kernel(self):
+        """
+        Returns True if step() should use the compiled kernel; False otherwise.
+
+        The kernel needs numba, and is only worth it for many points and few clusters
+        (see KERNEL_MIN_POINTS and KERNEL_MAX_CLUSTERS).  It is never used with quantize.
+        """
+        return (kernels is not None and not self._quantize and
+            len(self._points) >= KERNEL_MIN_POINTS and
+            len(self._cluster) < KERNEL_MAX_CLUSTERS)
+
+
+    def _step_fused(self):
+        """
+        Returns True if the algorithm converges after one step; False otherwise.
+
+        This method does the same work as _partition followed by _update, but uses
+        the compiled kernel to assign the points and sum each cluster in one pass.
+        The kernel reads the float64 points, since the same values are summed.
+        """
+        k, d = self._centroids.shape
+        labels = numpy.empty(len(self._points), dtype=numpy.int64)
+        sums = numpy.empty((k, d), dtype=numpy.float64)
+        counts = numpy.empty(k, dtype=numpy.int64)
+        kernels.lloyd_step(self._data, self._centroids, labels, sums, counts)
+        self._set_labels(labels, sums, counts)
+
+        # The Elkan bounds are not kept up to date, so _partition must start over
+        self._assignments = None
+        return self._update()
+
+
+    def _step_parallel(self):
+        """
+        Returns True if the algorithm converges after one step; False otherwise.
+
+        This method does the same work as _partition followed by _update, but splits
+        the points between the worker processes of run().  Each worker assigns its
+        points and sums each cluster, and the results are added together here.
+        """
+        n = len(self._points)
+        bounds = numpy.linspace(0, n, self._processes+1).astype(int)
+        tasks = [(bounds[i], bounds[i+1], self._shifted, self._center)
+            for i in range(self._processes) if bounds[i] < bounds[i+1]]
+        results = self._pool.map(_lloyd_chunk, tasks)
+
+        labels = numpy.concatenate([result[0] for result in results])
+        sums = sum(result[1] for result in results)
+        self._set_labels(labels, sums, numpy.bincount(labels, minlength=len(self._cluster)))
+
+        # The Elkan bounds are not kept up to date, so _partition must start over
+        self._assignments = None
+        return self._update()
+
+
     def run(self, maxstep):
         """
         Continues clustering until either it converges or performs maxstep steps.
@@ -157,6 +562,49 @@ class Algorithm(object):
         After the maxstep call to step, if this calculation did not converge, this
         method will stop.
 
+        If this object was created with more than one process and without quantize,
+        and numba is not installed, the steps are split between that many worker
+        processes.  With numba, the compiled kernel already uses every core, and
+        forking after its threads have started is not safe.
+
+        Parameter maxstep: The maximum number of steps to perform
+        Precondition: maxstep is an int >= 0
+        """
+        assert isinstance(maxstep, int) and maxstep >= 0
+
+        if maxstep == 0:
+            return
+
+        if (self._processes == None or self._processes == 1 or self._quantize or
+                kernels is not None):
+            self._run(maxstep)
+            return
+
+        if len(self._data) != self._dataset.getSize():
+            self._load_points()
+
+        # Share the points with the workers once, instead of sending them every step.
+        # The workers sum the points too, so they get the float64 values.
+        shape, dtype = self._data.shape, self._data.dtype
+        shm = shared_memory.SharedMemory(create=True, size=max(self._data.nbytes, 1))
+        try:
+            shared = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            shared[:] = self._data
+            del shared
+            with multiprocessing.Pool(self._processes, initializer=_init_worker,
+                    initargs=(shm.name, shape, dtype.str)) as pool:
+                self._pool = pool
+                self._run(maxstep)
+        finally:
+            self._pool = None
+            shm.close()
+            shm.unlink()
+
+
+    def _run(self, maxstep):
+        """
+        Calls step() up to maxstep times, stopping early if the algorithm converges.
+
         Parameter maxstep: The maximum number of steps to perform
         Precondition: maxstep is an int >= 0
         """
@@ -165,8 +613,6 @@ class Algorithm(object):
         # has not converged.
         # You do not need a while loop for this.  Just write a for-loop, and exit
         # the for-loop (with a return) if you finish early.
-        assert isinstance(maxstep, int) and maxstep >= 0
-
         for i in range(maxstep):
             converge = self.step()
             if converge:
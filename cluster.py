@@ -29,6 +29,8 @@ class Cluster(object):
         This method returns the indices directly (not a copy). Any changes made to this
         list will modify the cluster.
         """
+        # The caller may change the list, so any sums kept elsewhere are now suspect
+        self._modified = True
         return self._indices
 
     def getCentroid(self):
@@ -56,7 +58,11 @@ class Cluster(object):
 
         self._dataset = dset
         self._centroid = centroid
+        self._centroid_arr = numpy.asarray(centroid, dtype=numpy.float64)
+        self._distance_sq_fn = dset.getDistanceSq()
         self._indices = []
+        # True if the indices may have changed since the last call to _set_indices
+        self._modified = True
 
     def addIndex(self, index):
         """
@@ -72,6 +78,22 @@ class Cluster(object):
 
         if index not in self._indices:
             self._indices.append(index)
+            self._modified = True
+
+
+    def _set_indices(self, indices):
+        """
+        Replaces the indices of this cluster with the given list.
+
+        This is faster than calling clear() and then addIndex() for each index, as it
+        skips the checks that addIndex() performs.
+
+        Parameter indices: the new indices of this cluster
+        Precondition: indices is a list of unique valid indices into this cluster's
+        dataset.
+        """
+        self._indices = indices
+        self._modified = False
 
 
     def clear(self):
@@ -79,6 +101,7 @@ class Cluster(object):
         Removes all points from this cluster, but leaves the centroid unchanged.
         """
         self._indices.clear()
+        self._modified = True
 
 
     def getContents(self):
@@ -88,10 +111,9 @@ class Cluster(object):
         The result is a list of points (tuples of int/float). It has to be computed
         from the list of indices.
         """
-        temp = []
-        for i in self.getIndices():
-            temp.append(self._dataset.getPoint(i))
-        return temp
+        # The indices are known to be valid, so skip the checks in getPoint
+        contents = self._dataset.getContents()
+        return [contents[i] for i in self._indices]
 
 
     # Part B
@@ -106,32 +128,32 @@ class Cluster(object):
         assert dataset.is_point(point)
         assert len(point) == self._dataset.getDimension()
 
-        #Creates a nested listed with values of the point and centroid at each
-        #index i
-        all = []
-        for i in range(len(point)):
-            all.append([point[i]])
-        for i in range(len(self.getCentroid())):
-            all[i].append(self.getCentroid()[i])
-        sum = 0
-        for i in range(len(all)):
-            sum += ((all[i][0] - all[i][1])**2)
+        return math.sqrt(self._distance_sq(point))
+
+
+    def _distance_sq(self, point):
+        """
+        Returns the squared euclidean distance from point to this cluster's centroid.
+
+        Use this instead of distance() when only comparing distances, as it skips
+        the square root.
 
-        return sum**0.5
+        Parameter point: The point to be measured
+        Precondition: point is a tuple of numbers (int or float), with the same dimension
+        as the centroid.
+        """
+        return self._distance_sq_fn(point, self._centroid)
 
 
     def getRadius(self):
         """
         Returns the maximum distance from any point in this cluster, to the centroid.
 
-        This method loops over the contents of this cluster to find the maximum distance
-        from the centroid.
+        This method fetches the contents of this cluster once and computes the distance
+        of all of them to the centroid at the same time.
         """
-        distances = []
-        for point in self.getContents():
-            distances.append(self.distance(point))
-
-        return max(distances)
+        diff = numpy.asarray(self.getContents(), dtype=numpy.float64) - self._centroid_arr
+        return math.sqrt(float(numpy.einsum('nd,nd->n', diff, diff).max()))
 
     def update(self):
         """
@@ -147,30 +169,28 @@ class Cluster(object):
 
         If there are no points in the cluster, the centroid. does not change.
         """
-        #0 case
-        if len(self.getContents()) == 0:
+        if len(self._indices) == 0:
             return True
 
-        #Creates an empty nested list containing len(self.getContents()[0]) empty
-        #lists
-        recomputation = []
-        for i in range(len(self.getContents()[0])):
-            recomputation.append([])
+        new = self._dataset.getArray()[self._indices].mean(axis=0, dtype=numpy.float64)
+        return self._set_centroid(new)
+
 
-        #Adds lists of index of points from self.getContents() to recomputation
-        for point in self.getContents():
-            for i in range(len(point)):
-                recomputation[i].append(point[i])
+    def _set_centroid(self, centroid):
+        """
+        Returns True if centroid is the same as the old centroid; False otherwise.
 
-        #Sets recomputation[i] to mean of recomputation[i], computing the final
-        #recomputation
-        for i in range(len(recomputation)):
-            recomputation[i] = (sum(recomputation[i])/len(recomputation[i]))
+        This method replaces the centroid of this cluster.  Whether the centroid is "the
+        same" is determined by numpy.allclose, as in update().
 
-        old_centroid = self._centroid
-        self._centroid = recomputation
+        Parameter centroid: the new centroid
+        Precondition: centroid is a numpy array of dset.getDimension() floats
+        """
+        same = numpy.allclose(self._centroid_arr, centroid)
+        self._centroid_arr = centroid
+        self._centroid = tuple(centroid.tolist())
 
-        return numpy.allclose(old_centroid,recomputation)
+        return same
 
 
     def __str__(self):
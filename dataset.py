@@ -6,6 +6,13 @@ import random
 import numpy
 
 
+# Number of points allocated in the array of an empty data set
+INITIAL_CAPACITY = 16
+
+# Largest dimension for which make_distance_sq unrolls the loop over coordinates
+MAX_UNROLL = 32
+
+
 # HELPERS TO CHECK PRECONDITIONS
 def is_point(value):
     """
@@ -46,12 +53,42 @@ def is_point_list(value):
 
     return okay
 
+def make_distance_sq(dim):
+    """
+    Returns a function that computes the squared distance between two points.
+
+    The function takes two points p and c (sequences of dim numbers) and returns the
+    sum of (p[i]-c[i])**2. For dim <= MAX_UNROLL, the function is generated with the
+    loop over the coordinates written out, which is much faster than a loop or numpy
+    for a single pair of short tuples. Otherwise, it uses numpy.
+
+    Parameter dim: The dimension of the points
+    Precondition: dim is an int > 0
+    """
+    assert type(dim) == int and dim > 0
+
+    if dim > MAX_UNROLL:
+        def distance_sq(p, c):
+            diff = numpy.subtract(p, c, dtype=numpy.float64)
+            return float(numpy.dot(diff, diff))
+        return distance_sq
+
+    terms = ' + '.join('(p[%d]-c[%d])**2' % (i, i) for i in range(dim))
+    namespace = {}
+    exec('def distance_sq(p, c):\n    return ' + terms + '\n', namespace)
+    return namespace['distance_sq']
+
+
 class Dataset(object):
     """
     A class representing a dataset for k-means clustering.
 
     The data is stored as a list of points (int/float tuples). All points have
-    the same number elements which is the dimension of the data set.
+    the same number elements which is the dimension of the data set. A copy of the
+    data is also kept in contiguous numpy arrays for the k-means computations: a
+    float64 array with the exact values, and a float32 array for computing distances.
+    The float32 array is shifted by the center of the data, so that the rounding does
+    not depend on how far the data is from the origin.
 
     None of the attributes should be accessed directly outside of the class Dataset
     (e.g. in the methods of class Cluster or KMeans). Instead, this class has getter and
@@ -69,10 +106,7 @@ class Dataset(object):
         """
         Returns the number of points in this data set.
         """
-        try:
-            return len(self.getContents())
-        except:
-            return 0
+        return self._size
 
     def getContents(self):
         """
@@ -80,10 +114,91 @@ class Dataset(object):
 
         This method returns the contents directly (not a copy). Any changes made to this
         list will modify the data set. If you want to access the data set, but want to
-        protect yourself from modifying the data, use getPoint() instead.
+        protect yourself from modifying the data, use getPoint() instead. To add points,
+        use addPoint(), as getSize() and getArray() do not see changes made to this list.
+
+        If the data set was created from a numpy array, the list is built on the first
+        call to this method.
         """
+        if self._contents is None:
+            self._contents = [tuple(point) for point in self._source.tolist()]
+            self._source = None
         return self._contents
 
+    def getDistanceSq(self):
+        """
+        Returns a function computing the squared distance between two points.
+
+        The function is specialized to the dimension of this data set when the data
+        set is created (see make_distance_sq). It takes two points, and does not check
+        them.
+        """
+        return self._distance_sq
+
+    def getArray(self):
+        """
+        Returns the contents of this data set as an (n,d) numpy array of float64.
+
+        The array is kept up to date by addPoint(). Changes made to the list returned
+        by getContents() are not reflected in the array. The array is a view of the
+        internal buffer and should be treated as read-only.
+        """
+        return self._data[:self._size]
+
+    def getArray32(self):
+        """
+        Returns the contents of this data set as an (n,d) numpy array of float32.
+
+        This is getArray() minus getCenter(), rounded to float32. Shifting the points
+        does not change the distances between them, but keeps the float32 values small
+        even when the data is far from the origin. It is half the size of getArray(), so
+        it is used to compute distances, but not to compute means. The array is a view
+        of the internal buffer and should be treated as read-only.
+        """
+        return self._array[:self._size]
+
+    def getCenter(self):
+        """
+        Returns the point subtracted from every point in getArray32().
+
+        The center is the mean of the initial contents (or the first point added to an
+        empty data set), rounded to whole numbers so that shifting integer points is
+        exact. It is a numpy array of float64, and it does not change afterwards.
+        """
+        return self._center
+
+    def getSquaredNorms(self):
+        """
+        Returns the squared norm of every point of this data set as an (n,) numpy array.
+
+        The norms are those of the points in getArray32(). They are computed (in
+        float64) when points are added, so that distances
+        can be computed as ||x-c||^2 = ||x||^2 + ||c||^2 - 2x.c. The array is a view of
+        the internal buffer and should be treated as read-only.
+        """
+        return self._xx[:self._size]
+
+    def getQuantized(self):
+        """
+        Returns the contents of this data set quantized to 8 bits per coordinate.
+
+        The result is a tuple (array, scale, offset). The array is an (n,d) numpy array
+        of uint8, where each point x of getArray32() is stored as round((x-offset)*scale).
+        The offset is the minimum of each coordinate and the scale is the same for every
+        coordinate, so that the largest range along any axis fills 0..255. A single scale keeps
+        the order of the distances between points (up to rounding).
+
+        The result is computed once and cached until addPoint() is called.
+        """
+        if self._quantized is None:
+            array = self.getArray32()
+            offset = array.min(axis=0).astype(numpy.float64)
+            span = float((array.max(axis=0) - offset).max())
+            scale = 255.0/span if span > 0 else 1.0
+            quantized = numpy.rint((array - offset)*scale).astype(numpy.uint8)
+            self._quantized = (quantized, scale, offset)
+        return self._quantized
+
     def __init__(self, dim, contents=None):
         """
         Initializes a database for the given point dimension.
@@ -93,6 +208,11 @@ class Dataset(object):
         However, since tuples are not mutable, it does not need to copy the points
         themselves.  Hence a shallow copy is acceptable.
 
+        The contents may also be given as an (n,dim) numpy array. In that case only the
+        shape of the array is checked, and the list of points is not built until it
+        is needed. If the array is already float64, it is used without copying, so it
+        should not be modified afterwards.
+
         If contents is None, the data set start off empty. The parameter contents is
         None by default.
 
@@ -100,18 +220,40 @@ class Dataset(object):
         Precondition: dim is an int > 0
 
         Parameter contents: the dataset contents
-        Precondition: contents is either None or a list of points (int/float tuples).
-        If contents is not None, then contents is not empty and the length of each
-        point is equal to dim.
+        Precondition: contents is either None, a list of points (int/float tuples), or
+        a 2-dimensional numpy array of ints or floats. If contents is not None, then contents
+        is not empty and the length of each point is equal to dim.
         """
         assert type(dim) == int and dim > 0, "Dim is not an int greater than 0"
-        assert is_point_list(contents) or contents == None, "The contents are neither a list of points or None"
 
         self._dimension = dim
-        if contents==None:
-            self._contents = []
+        self._distance_sq = make_distance_sq(dim)
+        self._source = None
+        if isinstance(contents, numpy.ndarray):
+            assert contents.ndim == 2 and contents.shape[0] > 0 and \
+            contents.shape[1] == dim, "The contents are not an (n,dim) array"
+            assert numpy.issubdtype(contents.dtype, numpy.integer) or \
+            numpy.issubdtype(contents.dtype, numpy.floating), \
+            "The contents are not an array of ints or floats"
+            self._contents = None
+            self._source = contents
+            self._data = numpy.ascontiguousarray(contents, dtype=numpy.float64)
+        else:
+            assert is_point_list(contents) or contents is None, "The contents are neither a list of points or None"
+            if contents is None:
+                self._contents = []
+                self._data = numpy.zeros((INITIAL_CAPACITY, dim), dtype=numpy.float64)
+            else:
+                self._contents = contents[:]
+                self._data = numpy.array(contents, dtype=numpy.float64)
+        if contents is None:
+            self._center = numpy.zeros(dim, dtype=numpy.float64)
         else:
-            self._contents = contents[:]
+            self._center = numpy.rint(self._data.mean(axis=0))
+        self._array = (self._data - self._center).astype(numpy.float32)
+        self._xx = numpy.einsum('nd,nd->n', self._array, self._array, dtype=numpy.float64)
+        self._size = len(self._data) if contents is not None else 0
+        self._quantized = None
 
 
     def getPoint(self, i):
@@ -131,7 +273,10 @@ class Dataset(object):
         Precondition: i is an int that refers to a valid position in 0..getSize()-1
         """
         assert type(i) == int and 0 <= i and (self.getSize()-1) >= i, "type is not an int at a valid position"
-        return self.getContents()[i]
+        if self._contents is None:
+            # Do not build the whole list for a single point
+            return tuple(self._source[i].tolist())
+        return self._contents[i]
 
     def addPoint(self,point):
         """
@@ -144,4 +289,24 @@ class Dataset(object):
         to getDimension().
         """
         assert is_point(point) and len(point) == self.getDimension()
-        self._contents.append(point)
+        size = self._size
+        if size == len(self._data):
+            # Double the buffers when they are full
+            capacity = max(2*size, INITIAL_CAPACITY)
+            data = numpy.empty((capacity, self._dimension), dtype=numpy.float64)
+            data[:size] = self._data[:size]
+            self._data = data
+            array = numpy.empty((capacity, self._dimension), dtype=numpy.float32)
+            array[:size] = self._array[:size]
+            self._array = array
+            xx = numpy.empty(capacity, dtype=numpy.float64)
+            xx[:size] = self._xx[:size]
+            self._xx = xx
+        self._data[size] = point
+        if size == 0:
+            self._center = numpy.rint(self._data[0])
+        self._array[size] = self._data[size] - self._center
+        self._xx[size] = numpy.dot(self._array[size], self._array[size].astype(numpy.float64))
+        self.getContents().append(point)
+        self._size = size + 1
+        self._quantized = None
@@ -0,0 +1,74 @@
+"""
+Compiled kernels for K-Means clustering.
+
+This module requires numba. The module algorithm uses these kernels for large data
+sets when numba is installed, and falls back to plain numpy otherwise. The compiled
+code is cached on disk, so only the first use ever pays for the compilation.
+"""
+import numpy
+from numba import njit, prange, get_num_threads
+
+
+def lloyd_step(X, C, labels, sums, counts):
+    """
+    Assigns every point to its nearest centroid and sums the points of each cluster.
+
+    This does the partition and the accumulation for the update in a single pass over
+    X. Each thread works on its own slice of the points with its own sums and counts,
+    which are added together at the end.
+
+    Ties are broken in favor of centroids with a lower index.
+
+    Parameter X: the points
+    Precondition: X is an (n,d) numpy array of floats
+
+    Parameter C: the centroids
+    Precondition: C is a (k,d) numpy array of floats
+
+    Parameter labels: the array to store the index of the nearest centroid of each point
+    Precondition: labels is an (n,) numpy array of ints
+
+    Parameter sums: the array to store the sum of the points in each cluster
+    Precondition: sums is a (k,d) numpy array of float64
+
+    Parameter counts: the array to store the number of points in each cluster
+    Precondition: counts is a (k,) numpy array of ints
+    """
+    # The thread count is read here, as calling get_num_threads from compiled code
+    # prevents numba from caching it
+    _lloyd_step(X, C, labels, sums, counts, get_num_threads())
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _lloyd_step(X, C, labels, sums, counts, nthreads):
+    """
+    Does the work of lloyd_step, with each of nthreads threads taking a slice of X.
+    """
+    n, d = X.shape
+    k = C.shape[0]
+    chunk = (n + nthreads - 1) // nthreads
+    local_sums = numpy.zeros((nthreads, k, d))
+    local_counts = numpy.zeros((nthreads, k), dtype=counts.dtype)
+
+    for t in prange(nthreads):
+        for i in range(t*chunk, min(n, (t+1)*chunk)):
+            best = 0
+            best_dist = numpy.inf
+            for j in range(k):
+                dist = 0.0
+                for a in range(d):
+                    diff = X[i, a] - C[j, a]
+                    dist += diff*diff
+                if dist < best_dist:
+                    best_dist = dist
+                    best = j
+            labels[i] = best
+            local_counts[t, best] += 1
+            for a in range(d):
+                local_sums[t, best, a] += X[i, a]
+
+    sums[:] = 0
+    counts[:] = 0
+    for t in range(nthreads):
+        sums += local_sums[t]
+        counts += local_counts[t]